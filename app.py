@@ -1,79 +1,147 @@
-from flask import Flask, request, jsonify, send_file
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import numpy as np
-import tempfile
+from flask import Flask, Response, request, jsonify, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+import orjson
 import base64
 import uuid
 import os
-from matplotlib.patches import Rectangle
 import re
+import hashlib
+import json
+import io
+import threading
+import logging
 
 app = Flask(__name__)
+# Only enable behind a front server (nginx, Apache) that honours X-Sendfile;
+# otherwise send_file already streams through the WSGI server's file_wrapper.
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+logger = logging.getLogger(__name__)
+
+# Drawings are stored once per distinct payload and double as the render cache;
+# nothing is evicted, so download links stay valid until the disk is wiped.
+DOWNLOAD_DIR = "downloads"
+MAX_PAYLOAD_BYTES = 64 * 1024
+SMALL_CULVERT_GID = "small-culvert-warning"
+
+# Werkzeug rejects oversized Content-Length bodies outright, but silently truncates
+# chunked ones at the limit. Allowing one extra byte lets the route spot a cut-off body.
+app.config["MAX_CONTENT_LENGTH"] = MAX_PAYLOAD_BYTES + 1
+
+# One Figure per worker thread, reused across requests. Being thread-local it is
+# never drawn on by two requests at once, so no lock is needed.
+_TLS = threading.local()
+
+_GREATER_RE = re.compile(r'greater than\s*(\d+(?:\.\d+)?)')
 
 def mm_to_m(v): 
     return float(v) / 1000.0
 
+def payload_key(payload):
+    """Stable hash of the request payload, used as the rendered PNG's filename"""
+    canonical = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+def store_drawing(path, png_bytes):
+    """Write a rendered PNG via a temp file so downloads never see it half-written"""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(DOWNLOAD_DIR, f".tmp-{uuid.uuid4().hex}.png")
+    with open(tmp_path, 'wb') as f:
+        f.write(png_bytes)
+    os.replace(tmp_path, path)
+
+def parse_length(value, default, unit):
+    """Parse a measurement such as "150 mm", "12.5m" or 150 into a float in `unit`.
+
+    Missing values and "N/A - Culvert too small" fall back to `default`.
+    """
+    if value is None:
+        return float(default)
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().lower()
+    if text.startswith("n/a"):
+        return float(default)
+    return float(text.removesuffix(unit).strip())
+
+def get_figure():
+    """Return this thread's Figure and its two axes, wiped clean for a new drawing"""
+    fig = getattr(_TLS, "fig", None)
+    if fig is None:
+        # matplotlib is imported on first use so cold starts and health checks don't pay for it
+        from matplotlib.figure import Figure
+        # Build the Figure directly rather than through pyplot: no global figure
+        # manager, no GUI backend, nothing to close afterwards
+        fig = Figure(figsize=(14, 10))
+        _TLS.fig = fig
+        _TLS.axes = tuple(fig.subplots(2, 1))
+        # Fixed margins instead of tight_layout/bbox_inches='tight', which measure by rendering the figure
+        fig.subplots_adjust(left=0.05, right=0.98, top=0.93, bottom=0.05, hspace=0.2)
+        fig.patch.set_edgecolor('#16416f')
+        fig.patch.set_linewidth(3)
+    else:
+        for ax in _TLS.axes:
+            ax.clear()
+        for text in fig.texts[:]:
+            if text.get_gid() == SMALL_CULVERT_GID:
+                text.remove()
+    return fig, _TLS.axes
+
 def parse_gradient(gradient_str):
     """Parse gradient string and handle 'greater than X%' format"""
     original_str = str(gradient_str)
     gradient_str = str(gradient_str).lower()
     
-    print(f"Gradient parsing - Original: '{original_str}', Lowercase: '{gradient_str}'")
+    logger.debug("Gradient parsing - Original: '%s', Lowercase: '%s'", original_str, gradient_str)
     
     if "nan" in gradient_str or gradient_str == "nan%":
-        print("Detected NaN gradient, returning 0.0")
+        logger.debug("Detected NaN gradient, returning 0.0")
         return 0.0
     
     if "greater than" in gradient_str:
-        print("Detected 'greater than' format")
-        match = re.search(r'greater than\s*(\d+(?:\.\d+)?)', gradient_str)
+        logger.debug("Detected 'greater than' format")
+        match = _GREATER_RE.search(gradient_str)
         if match:
             value = float(match.group(1)) / 100.0
-            print(f"Extracted value: {value}")
+            logger.debug("Extracted value: %s", value)
             return value
         else:
-            print("Could not extract number from 'greater than' format")
+            logger.debug("Could not extract number from 'greater than' format")
     
     gradient_str = gradient_str.replace("%", "")
     try:
         value = float(gradient_str)
         if value != value:
-            print("Detected NaN value, returning 0.0")
+            logger.debug("Detected NaN value, returning 0.0")
             return 0.0
         result = value / 100.0
-        print(f"Standard parsing result: {result}")
+        logger.debug("Standard parsing result: %s", result)
         return result
     except (ValueError, TypeError) as e:
-        print(f"Parsing failed with error: {e}, returning 0.0")
+        logger.debug("Parsing failed with error: %s, returning 0.0", e)
         return 0.0
 
-def generate_drawing(data, filename):
+def generate_drawing(data, out):
+    """Render the schematic as PNG into `out`, a file path or binary file object"""
     # ---- inputs & defaults ----
-    length_m = float(str(data.get("culvertLength", data.get("Culvert Length", data.get("length", 10)))).replace(" m", ""))
+    length_m = parse_length(data.get("culvertLength", data.get("Culvert Length", data.get("length"))), 10, "m")
     
-    diameter_str = str(data.get("diameter", "1200 mm")).replace(" mm", "")
-    diameter_m = mm_to_m(float(diameter_str))
+    diameter_mm = parse_length(data.get("diameter"), 1200, "mm")
+    diameter_m = mm_to_m(diameter_mm)
     
     # CHECK FOR SMALL CULVERTS - Flag but continue drawing (without baffles)
-    is_small_culvert = float(diameter_str) <= 599
+    is_small_culvert = diameter_mm <= 599
     if is_small_culvert:
-        print(f"Culvert diameter {diameter_str}mm is too small - drawing without baffles and adding warning overlay")
+        logger.debug("Culvert diameter %gmm is too small - drawing without baffles and adding warning overlay", diameter_mm)
         # Set default values for baffle measurements since they'll be N/A
         baffle_h_m = 0.15  # Default 150mm just for drawing purposes
         baffle_len_m = 0.6  # Default 600mm
         spacing_m = 0.8  # Default 800mm
     else:
         # Normal processing for culverts over 599mm
-        baffle_h_str = str(data.get("baffleHeight", "150 mm")).replace(" mm", "").replace("N/A - Culvert too small", "150")
-        baffle_h_m = mm_to_m(float(baffle_h_str))
-        
-        baffle_len_str = str(data.get("baffleLength", "600 mm")).replace(" mm", "").replace("N/A - Culvert too small", "600")
-        baffle_len_m = mm_to_m(float(baffle_len_str))
-        
-        spacing_str = str(data.get("spacing", "800 mm")).replace(" mm", "").replace("N/A - Culvert too small", "800")
-        spacing_m = mm_to_m(float(spacing_str))
+        baffle_h_m = mm_to_m(parse_length(data.get("baffleHeight"), 150, "mm"))
+        baffle_len_m = mm_to_m(parse_length(data.get("baffleLength"), 600, "mm"))
+        spacing_m = mm_to_m(parse_length(data.get("spacing"), 800, "mm"))
     
     # CONTINUE WITH NORMAL PROCESSING
     gradient_str = str(data.get("gradient", "0%"))
@@ -87,27 +155,27 @@ def generate_drawing(data, filename):
     
     installation = str(data.get("installation", "")).lower()
     
-    print(f"Installation value received: '{installation}'")
+    logger.debug("Installation value received: '%s'", installation)
     
     box_w_m = diameter_m
     box_h_m = diameter_m
     
     if any(keyword in installation for keyword in ["offset", "alternating", "meander", "20% shorter"]):
         placement = "offset"
-        print("Setting placement to OFFSET")
+        logger.debug("Setting placement to OFFSET")
         if shape == "round":
             lateral_offset_m = 0.05
         else:
             lateral_offset_m = 0.0
     elif any(keyword in installation for keyword in ["centered", "centred", "full width", "full-width"]) or installation == "":
         placement = "centered"
-        print("Setting placement to CENTERED")
+        logger.debug("Setting placement to CENTERED")
         lateral_offset_m = 0.0
         if shape == "box":
             baffle_len_m = box_h_m
     else:
         placement = "centered"
-        print(f"Defaulting to CENTERED - unknown installation value: '{installation}'")
+        logger.debug("Defaulting to CENTERED - unknown installation value: '%s'", installation)
         lateral_offset_m = 0.0
         if shape == "box":
             baffle_len_m = box_h_m
@@ -124,53 +192,52 @@ def generate_drawing(data, filename):
     if is_small_culvert:
         x_positions = []
 
-    fig, (ax_long, ax_plan) = plt.subplots(2, 1, figsize=(14, 10))
+    from matplotlib.collections import LineCollection
+
+    fig, (ax_long, ax_plan) = get_figure()
     
     if shape == "round":
         title = f"Culvert {length_m:g}m | Ø{int(round(diameter_m*1000))}mm | Gradient {round(gradient*100,1)}%"
     else:
         title = f"Culvert {length_m:g}m | {int(round(box_w_m*1000))}×{int(round(box_h_m*1000))}mm | Gradient {round(gradient*100,1)}%"
     
-    fig.suptitle(title, fontsize=16, fontweight='bold', y=0.89, color='#16416f')
-
-    fig.patch.set_edgecolor('#16416f')
-    fig.patch.set_linewidth(3)
+    fig.suptitle(title, fontsize=16, fontweight='bold', y=0.97, color='#16416f')
 
     # Longitudinal view
     ax_long.set_title("LONGITUDINAL VIEW", fontweight='bold', fontsize=12, pad=0, color='#16416f', y=0.80)
     
     if shape == "round":
         radius = diameter_m / 2.0
-        x_curve = np.linspace(0, length_m, 100)
-        y_top = -x_curve * gradient + radius
-        y_bottom = -x_curve * gradient - radius
+        # Constant gradient, so the outline is a straight line: two endpoints suffice
+        x_line = [0, length_m]
+        y_top = [radius, -length_m * gradient + radius]
+        y_bottom = [-radius, -length_m * gradient - radius]
         
-        ax_long.plot(x_curve, y_top, color='#16416f', linewidth=2)
-        ax_long.plot(x_curve, y_bottom, color='#16416f', linewidth=2)
+        ax_long.plot(x_line, y_top, color='#16416f', linewidth=2)
+        ax_long.plot(x_line, y_bottom, color='#16416f', linewidth=2)
         
-        for x in x_positions:
-            y_bottom_at_x = -x * gradient - radius
-            baffle_top = y_bottom_at_x + baffle_h_m
-            ax_long.plot([x, x], [y_bottom_at_x, baffle_top], color='#16416f', linewidth=3)
+        baffle_bottoms = [(x, -x * gradient - radius) for x in x_positions]
             
         culvert_height = diameter_m
         
     else:
         height = box_h_m
-        x_line = np.array([0, length_m])
-        y_top = -x_line * gradient + height/2
-        y_bottom = -x_line * gradient - height/2
+        x_line = [0, length_m]
+        y_top = [height/2, -length_m * gradient + height/2]
+        y_bottom = [-height/2, -length_m * gradient - height/2]
         
         ax_long.plot(x_line, y_top, color='#16416f', linewidth=2)
         ax_long.plot(x_line, y_bottom, color='#16416f', linewidth=2)
         
-        for x in x_positions:
-            y_bottom_at_x = -x * gradient - height/2
-            baffle_top = y_bottom_at_x + baffle_h_m
-            ax_long.plot([x, x], [y_bottom_at_x, baffle_top], color='#16416f', linewidth=3)
+        baffle_bottoms = [(x, -x * gradient - height/2) for x in x_positions]
             
         culvert_height = box_h_m
 
+    # All baffles go in as one artist rather than a Line2D each
+    ax_long.add_collection(LineCollection(
+        [((x, y), (x, y + baffle_h_m)) for x, y in baffle_bottoms],
+        colors='#16416f', linewidths=3, capstyle='projecting', zorder=2))
+
     if len(x_positions) >= 2:
         x1, x2 = x_positions[0], x_positions[1]
         if shape == "round":
@@ -232,6 +299,7 @@ def generate_drawing(data, filename):
                 ha='center', va='center', fontsize=11, fontweight='bold', color='#16416f',
                 bbox=dict(boxstyle="round,pad=0.3", facecolor="white", edgecolor="#89ccea"))
 
+    plan_baffles = []
     for i, x in enumerate(x_positions):
         if placement == "offset" and shape == "box":
             if i % 2 == 0:
@@ -253,7 +321,10 @@ def generate_drawing(data, filename):
             y_start = y_center - baffle_len_m/2
             y_end = y_center + baffle_len_m/2
         
-        ax_plan.plot([x, x], [y_start, y_end], color='#16416f', linewidth=3)
+        plan_baffles.append(((x, y_start), (x, y_end)))
+
+    ax_plan.add_collection(LineCollection(
+        plan_baffles, colors='#16416f', linewidths=3, capstyle='projecting', zorder=2))
 
     if x_positions and (placement != "centered" or shape == "round"):
         x_ref = x_positions[0]
@@ -291,98 +362,114 @@ def generate_drawing(data, filename):
     ax_plan.set_xlim(-1.0, length_m + 1.0)
     ax_plan.set_ylim(-culvert_width/2 - 0.8, culvert_width/2 + 1.2)
     ax_plan.axis('off')
-
-    plt.tight_layout()
-    plt.subplots_adjust(top=0.90)
-    
-    fig.patch.set_edgecolor('#16416f')
-    fig.patch.set_linewidth(3)
     
     # Add warning overlay for small culverts
     if is_small_culvert:
         # Add semi-transparent warning banner across entire figure
         fig.text(0.5, 0.5, 
                 'CULVERT TOO SMALL FOR BAFFLES \n\n'
-                f'Diameter: {diameter_str}mm\n\n'
+                f'Diameter: {diameter_mm:g}mm\n\n'
                 'Culverts 599mm or under require alternative solutions.\n'
                 'Please contact us directly for fish passage options.',
                 ha='center', va='center', fontsize=16, fontweight='bold',
                 color='#16416f', 
                 bbox=dict(boxstyle="round,pad=1.5", facecolor='#89ccea', 
                          edgecolor='#16416f', linewidth=4, alpha=0.9),
-                transform=fig.transFigure, zorder=100)
+                transform=fig.transFigure, zorder=100, gid=SMALL_CULVERT_GID)
     
-    plt.savefig(filename, dpi=200, bbox_inches='tight', facecolor='white')
-    plt.close(fig)
+    # Flat-colour line art barely compresses better at higher zlib levels, so favour encode speed
+    fig.savefig(out, format='png', dpi=200, facecolor='white',
+                pil_kwargs={"compress_level": 1, "optimize": False})
+
+
+@app.route("/")
+def health():
+    return jsonify({"status": "ok"})
 
 
 @app.route("/download/<filename>")
 def download_file(filename):
     """Serve files for download"""
-    if os.path.exists(filename) and filename.endswith('.png'):
-        return send_file(filename, as_attachment=True, download_name='culvert_schematic.png')
-    else:
+    safe_name = secure_filename(filename)
+    if not safe_name.endswith('.png'):
+        return "File not found", 404
+    path = os.path.abspath(os.path.join(DOWNLOAD_DIR, safe_name))
+    
+    # send_file's own stat doubles as the existence check; passing the path keeps
+    # Content-Length, ETag, Last-Modified, Range support and X-Sendfile working
+    try:
+        return send_file(path, mimetype='image/png', as_attachment=True, download_name='culvert_schematic.png')
+    except FileNotFoundError:
         return "File not found", 404
 
 
 @app.route("/flexibaffle_drawings", methods=["POST"])
 def flexibaffle_drawings():
     try:
-        print(f"Content-Type: {request.content_type}")
-        print(f"Request data: {request.get_data()}")
-        
-        payload = None
+        logger.debug("Content-Type: %s", request.content_type)
         
+        # get_data caches the body, so get_json below parses it without re-reading
         try:
-            payload = request.get_json()
-        except:
-            pass
-            
-        if not payload:
-            try:
-                payload = request.get_json(force=True)
-            except:
-                pass
+            too_large = len(request.get_data()) > MAX_PAYLOAD_BYTES
+        except RequestEntityTooLarge:
+            too_large = True
+        if too_large:
+            return jsonify({"error": "Payload too large"}), 413
         
-        if not payload:
-            try:
-                import json
-                raw_data = request.get_data(as_text=True)
-                print(f"Raw data as text: {raw_data}")
-                payload = json.loads(raw_data)
-            except Exception as e:
-                print(f"Manual JSON parsing failed: {e}")
+        # force=True accepts Zapier bodies sent without a JSON content type
+        payload = request.get_json(force=True, silent=True)
         
-        if not payload:
+        if not payload or not isinstance(payload, dict):
             return jsonify({"error": "No valid JSON payload received"}), 400
             
-        print(f"Successfully parsed payload: {payload}")
+        logger.debug("Successfully parsed payload: %s", payload)
 
-        file_id = str(uuid.uuid4())
-        permanent_filename = f"{file_id}.png"
+        # Base64 inflates the response by a third, so only embed the image when asked to.
+        # The flag is popped before hashing so it doesn't split the drawing cache.
+        include_b64 = str(payload.pop("include_base64", "")).lower() in ("1", "true", "yes")
+        embed = request.args.get("embed") == "1" or include_b64
         
-        generate_drawing(payload, permanent_filename)
+        file_name = f"{payload_key(payload)}.png"
+        file_path = os.path.join(DOWNLOAD_DIR, file_name)
         
-        with open(permanent_filename, 'rb') as img_file:
-            img_b64 = base64.b64encode(img_file.read()).decode("utf-8")
-
-        download_url = f"https://culvert-baffle-api.onrender.com/download/{permanent_filename}"
+        png_bytes = None
+        try:
+            # stat rather than utime, so the file's Last-Modified/ETag stay stable for downloads
+            os.stat(file_path)
+            if embed:
+                with open(file_path, 'rb') as img_file:
+                    png_bytes = img_file.read()
+            hit = True
+        except FileNotFoundError:
+            hit = False
         
-        print("Image generated successfully")
-        return jsonify({
+        if hit:
+            logger.debug("Cache hit: %s", file_path)
+        else:
+            buf = io.BytesIO()
+            generate_drawing(payload, buf)
+            png_bytes = buf.getvalue()
+            store_drawing(file_path, png_bytes)
+
+        download_url = f"https://culvert-baffle-api.onrender.com/download/{file_name}"
+        result = {
             "download_url": download_url,
-            "image_base64": img_b64,
             "status": "success"
-        })
+        }
+        if embed:
+            result["image_base64"] = base64.b64encode(png_bytes).decode("utf-8")
+        
+        logger.debug("Image generated successfully")
+        # orjson encodes the (possibly multi-MB) base64 string far faster than the stdlib encoder
+        return Response(orjson.dumps(result), mimetype="application/json")
         
     except Exception as e:
-        print(f"Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error: %s", e)
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 
 if __name__ == "__main__":
     import os
+    logging.basicConfig(level=logging.WARNING)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)